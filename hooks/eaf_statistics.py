@@ -1,14 +1,30 @@
 import os
+import sys
+import io
+import struct
+import binascii
 import re
-import json
+import orjson
+import collections
 from lxml import etree
 from git import Repo
-import wave
-import contextlib
-import scipy.io.wavfile as wav
 import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 EAF_TIME_MULTIPLIER = 1000  # time stamps are in milliseconds
+SOUND_READ_THREADS = 16  # number of sound file headers read in parallel
+
+# XPath expressions are compiled once and reused for all files
+_XP_SEGS = etree.XPath('ANNOTATION/REF_ANNOTATION | ANNOTATION/ALIGNABLE_ANNOTATION')
+
+# Parser options for EAF files: insignificant whitespace and comments
+# are not needed, and ID attributes do not have to be indexed
+_PARSER_OPTIONS = {'remove_blank_text': True,
+                   'remove_comments': True,
+                   'collect_ids': False,
+                   'huge_tree': True}
+
+_workerStats = None  # EafStats instance used by a worker process
 
 
 class EafStats:
@@ -23,26 +39,66 @@ class EafStats:
     rxStripExt = re.compile('\\.[^.]*$')
     rxBadSentence = re.compile('[^а-яё./ -]')
     rxWord = re.compile('\\b\\w[\\w-]*\\b')
+    rxConvert = re.compile('\\[нрзб|говорит [^\\[\\]]+\\] *|\\[|[/\\]"?!]+')
 
     def __init__(self, main_tiers, aligned_tiers, tier_languages, sound_path, stats_path):
         self.srcExt = 'eaf'
         self.tlis = {}  # time labels
         self.participants = {}  # main tier ID -> participant ID
-        self.segmentTree = {}  # aID -> (contents, parent aID, tli1, tli2)
+        # Segment data is stored in parallel dictionaries indexed by aID
+        self.segContents = {}  # aID -> contents
+        self.segParent = {}  # aID -> parent aID
+        self.segTli1 = {}  # aID -> tli1
+        self.segTli2 = {}  # aID -> tli2
         self.segmentChildren = {}  # (aID, child tier type) -> [child aID]
+        self.tierRoles = {}  # (tier ID, tier type) -> (is main, is aligned, language)
         self.corpusSettings = {'main_tiers': main_tiers,
                                'aligned_tiers': aligned_tiers,
                                'tier_languages': tier_languages,
                                'sound_path': sound_path,
                                'stats_path': stats_path}
         self.phraseID = 0
+        self.pID = 0  # ID of the last main tier sentence, for aligned tiers
+        self.nSkippedAligned = 0  # aligned segments without a main tier parent in the current file
+        self.logFile = None  # open only while a repository is being processed
+        self.rxMainTiers = self.compile_tier_regexes(main_tiers)
+        self.rxAlignedTiers = self.compile_tier_regexes(aligned_tiers)
+        self.rxTierLanguages = self.compile_tier_regexes(tier_languages)
+        self.rxAnalysisTiers = self.compile_tier_regexes(self.corpusSettings.get('analysis_tiers', {}))
+
+    def __getstate__(self):
+        # The log file is only written by the main process and
+        # cannot be passed to the workers
+        state = self.__dict__.copy()
+        state['logFile'] = None
+        return state
+
+    def compile_tier_regexes(self, tierRegexes):
+        """
+        Compile tier ID / tier type regexes from the settings. Return a list
+        of (compiled regex, value) tuples. If tierRegexes is a list, the values
+        are the regexes themselves. Malformed regexes are skipped.
+        """
+        if type(tierRegexes) == dict:
+            tierRegexes = tierRegexes.items()
+        else:
+            tierRegexes = [(k, k) for k in tierRegexes]
+        rxTiers = []
+        for k, v in tierRegexes:
+            if not k.startswith('^'):
+                k = '^' + k
+            if not k.endswith('$'):
+                k += '$'
+            try:
+                rxTiers.append((re.compile(k), v))
+            except re.error:
+                print('Wrong tier regex: ' + k)
+        return rxTiers
 
     def convert_sentence(self, text):
-        text = text.strip().lower()
-        text = re.sub('\\[нрзб|говорит [^\\[\\]]+\\] *', '', text)
-        text = re.sub('[/\\[\\]"?!]+', '', text)
-        text = text.replace('...', '')
-        return text
+        # '...' is removed afterwards: dots may only become adjacent
+        # once the other characters are gone
+        return self.rxConvert.sub('', text.strip().lower()).replace('...', '')
 
     def is_bad_sentence(self, text):
         # This function is not used at present
@@ -54,73 +110,47 @@ class EafStats:
         """
         Present duration in a human-readable form.
         """
-        totalDurHours = round(duration // 3600)
-        totalDurMinutes = round((duration - totalDurHours * 3600) // 60)
-        totalDurSeconds = round(duration % 60)
-        return str(totalDurHours).zfill(2) + ':' + str(totalDurMinutes).zfill(2) + ':' + str(totalDurSeconds).zfill(2)
+        totalDurHours, totalDurSeconds = divmod(int(round(duration)), 3600)
+        totalDurMinutes, totalDurSeconds = divmod(totalDurSeconds, 60)
+        return f'{totalDurHours:02d}:{totalDurMinutes:02d}:{totalDurSeconds:02d}'
 
-    def get_tlis(self, srcTree):
-        """
-        Retrieve and return all time labels from the XML tree.
-        """
-        tlis = {}
-        iTli = 0
-        for tli in srcTree.xpath('/ANNOTATION_DOCUMENT/TIME_ORDER/TIME_SLOT'):
-            timeValue = ''
-            if 'TIME_VALUE' in tli.attrib:
-                timeValue = tli.attrib['TIME_VALUE']
-            tlis[tli.attrib['TIME_SLOT_ID']] = {'n': iTli, 'time': timeValue}
-            iTli += 1
-        return tlis
-
-    def traverse_tree(self, srcTree, callback):
+    def add_tli(self, tliNode):
         """
-        Iterate over all tiers in the XML tree and call the callback function
-        for each of them.
+        Store the time label from a TIME_SLOT node.
         """
-        for tierNode in srcTree.xpath('/ANNOTATION_DOCUMENT/TIER'):
-            if 'TIER_ID' not in tierNode.attrib:
-                continue
-            callback(tierNode)
+        timeValue = ''
+        if 'TIME_VALUE' in tliNode.attrib:
+            timeValue = tliNode.attrib['TIME_VALUE']
+        self.tlis[sys.intern(tliNode.attrib['TIME_SLOT_ID'])] = {'n': len(self.tlis), 'time': timeValue}
 
     def cb_build_segment_tree(self, tierNode):
         tierType = ''  # analysis tiers: word/POS/gramm/gloss etc.
-        if 'analysis_tiers' in self.corpusSettings:
-            for k, v in self.corpusSettings['analysis_tiers'].items():
-                if not k.startswith('^'):
-                    k = '^' + k
-                if not k.endswith('$'):
-                    k += '$'
-                try:
-                    rxTierID = re.compile(k)
-                    if (rxTierID.search(tierNode.attrib['TIER_ID']) is not None
-                            or rxTierID.search(tierNode.attrib['LINGUISTIC_TYPE_REF']) is not None):
-                        tierType = v
-                        break
-                except:
-                    print('Except')
-        for segNode in tierNode.xpath('ANNOTATION/REF_ANNOTATION | ANNOTATION/ALIGNABLE_ANNOTATION'):
+        for rxTierID, v in self.rxAnalysisTiers:
+            if (rxTierID.search(tierNode.attrib['TIER_ID']) is not None
+                    or rxTierID.search(tierNode.attrib.get('LINGUISTIC_TYPE_REF', '')) is not None):
+                tierType = v
+                break
+        for segNode in _XP_SEGS(tierNode):
             if 'ANNOTATION_ID' not in segNode.attrib:
                 continue
-            aID = segNode.attrib['ANNOTATION_ID']
-            try:
-                segContents = segNode.xpath('ANNOTATION_VALUE')[0].text.strip()
-            except AttributeError:
-                segContents = ''
+            aID = sys.intern(segNode.attrib['ANNOTATION_ID'])
+            segContents = (segNode.findtext('ANNOTATION_VALUE') or '').strip()
             try:
-                segParent = segNode.attrib['ANNOTATION_REF']
+                segParent = sys.intern(segNode.attrib['ANNOTATION_REF'])
             except KeyError:
                 segParent = None
-            tli1, tli2 = None, None
             if 'TIME_SLOT_REF1' in segNode.attrib:
-                tli1 = segNode.attrib['TIME_SLOT_REF1']
-            elif segParent in self.segmentTree and self.segmentTree[segParent][2] is not None:
-                tli1 = self.segmentTree[segParent][2]
+                tli1 = sys.intern(segNode.attrib['TIME_SLOT_REF1'])
+            else:
+                tli1 = self.segTli1.get(segParent)
             if 'TIME_SLOT_REF2' in segNode.attrib:
-                tli2 = segNode.attrib['TIME_SLOT_REF2']
-            elif segParent in self.segmentTree and self.segmentTree[segParent][3] is not None:
-                tli2 = self.segmentTree[segParent][3]
-            self.segmentTree[aID] = (segContents, segParent, tli1, tli2)
+                tli2 = sys.intern(segNode.attrib['TIME_SLOT_REF2'])
+            else:
+                tli2 = self.segTli2.get(segParent)
+            self.segContents[aID] = segContents
+            self.segParent[aID] = segParent
+            self.segTli1[aID] = tli1
+            self.segTli2[aID] = tli2
             if segParent is None:
                 continue
             if len(tierType) > 0:
@@ -129,15 +159,6 @@ class EafStats:
                 except KeyError:
                     self.segmentChildren[(segParent, tierType)] = [aID]
 
-    def build_segment_tree(self, srcTree):
-        """
-        Read the entire XML tree and save all segment data (contents, links to
-        the parents and timestamps, if any).
-        """
-        self.segmentTree = {}
-        self.segmentChildren = {}
-        self.traverse_tree(srcTree, self.cb_build_segment_tree)
-
     def add_src_alignment(self, sent, tli1, tli2, srcFile):
         """
         Add the alignment of the sentence with the sound/video. If
@@ -152,237 +173,319 @@ class EafStats:
                                'src': srcFile})
         sent['src_alignment'] = sentAlignments
 
-    def process_tier(self, tierNode, aID2pID, srcFile, alignedTier=False):
+    def classify_tier(self, tierNode):
         """
-        Extract segments from the tier node and iterate over them, returning
-        them as JSON sentences. If alignedTier is False, store the start and end
-        timestamps in the dictionary aID2pID.
-        If alignedTier is True, use the information from aID2pID for establishing
-        time boundaries of the sentences.
+        Find out whether the tier is a main and/or an aligned tier and
+        what language it represents. Return (is main, is aligned, language).
+        The result only depends on the tier ID and type, so it is cached:
+        the same tiers usually occur in all files of a corpus.
         """
+        tierID = tierNode.attrib['TIER_ID']
+        tierType = tierNode.attrib.get('LINGUISTIC_TYPE_REF')
+        if (tierID, tierType) in self.tierRoles:
+            return self.tierRoles[(tierID, tierType)]
+        isMain = self.tier_matches(tierNode, self.rxMainTiers)
+        isAligned = self.tier_matches(tierNode, self.rxAlignedTiers)
         lang = ''
         # We have to find out what language the tier represents.
         # First, check the tier type. If it is not associated with any language,
         # check all tier ID regexes.
-        if 'TIER_ID' not in tierNode.attrib:
-            return
-        if ('LINGUISTIC_TYPE_REF' in tierNode.attrib and
-                tierNode.attrib['LINGUISTIC_TYPE_REF'] in self.corpusSettings['tier_languages']):
-            lang = self.corpusSettings['tier_languages'][tierNode.attrib['LINGUISTIC_TYPE_REF']]
-        else:
-            for k, v in self.corpusSettings['tier_languages'].items():
-                if not k.startswith('^'):
-                    k = '^' + k
-                if not k.endswith('$'):
-                    k += '$'
-                try:
-                    rxTierID = re.compile(k)
-                    if rxTierID.search(tierNode.attrib['TIER_ID']) is not None:
-                        lang = v
-                        break
-                except:
-                    continue
-        if len(lang) <= 0:
-            return
+        if tierType is not None and tierType in self.corpusSettings['tier_languages']:
+            lang = self.corpusSettings['tier_languages'][tierType]
+        elif isMain or isAligned:
+            for rxTierID, v in self.rxTierLanguages:
+                if rxTierID.search(tierID) is not None:
+                    lang = v
+                    break
+        self.tierRoles[(tierID, tierType)] = (isMain, isAligned, lang)
+        return isMain, isAligned, lang
 
+    def tier_speaker(self, tierAttrib, alignedTier=False):
+        """
+        Find out who the speaker of the tier is, based on the tier's
+        attributes. Speakers of main tiers are remembered, so that
+        aligned tiers can inherit them.
+        """
         speaker = ''
-        if not alignedTier and 'PARTICIPANT' in tierNode.attrib:
-            speaker = tierNode.attrib['PARTICIPANT']
-            self.participants[tierNode.attrib['TIER_ID']] = speaker
+        if not alignedTier and 'PARTICIPANT' in tierAttrib:
+            speaker = tierAttrib['PARTICIPANT']
+            self.participants[tierAttrib['TIER_ID']] = speaker
         else:
-            if ('PARENT_REF' in tierNode.attrib
-                    and tierNode.attrib['PARENT_REF'] in self.participants):
-                speaker = self.participants[tierNode.attrib['PARENT_REF']]
-            elif 'PARTICIPANT' in tierNode.attrib:
-                speaker = tierNode.attrib['PARTICIPANT']
+            if ('PARENT_REF' in tierAttrib
+                    and tierAttrib['PARENT_REF'] in self.participants):
+                speaker = self.participants[tierAttrib['PARENT_REF']]
+            elif 'PARTICIPANT' in tierAttrib:
+                speaker = tierAttrib['PARTICIPANT']
+        return sys.intern(speaker)
 
-        segments = tierNode.xpath('ANNOTATION/REF_ANNOTATION | ANNOTATION/ALIGNABLE_ANNOTATION')
+    def make_sentence(self, segID, lang, speaker, aID2pID, srcFile, alignedTier=False):
+        """
+        Return the segment as a JSON sentence, or None if its time
+        boundaries cannot be established. If alignedTier is False, store
+        the start and end timestamps in the dictionary aID2pID.
+        If alignedTier is True, use the information from aID2pID for establishing
+        time boundaries of the sentence.
+        """
+        if not alignedTier:
+            tli1 = self.segTli1[segID]
+            tli2 = self.segTli2[segID]
+            if tli1 is None or tli2 is None:
+                return None
+        elif self.segParent[segID] is not None and self.segParent[segID] in aID2pID:
+            aID = self.segParent[segID]
+            pID, tli1, tli2 = aID2pID[aID]
+        else:
+            return None
+        text = self.segContents[segID]
+        curSent = {'text': text, 'words': None, 'lang': lang,
+                   'meta': {'speaker': speaker}}
+        if len(self.corpusSettings['aligned_tiers']) > 0:
+            if not alignedTier:
+                self.pID += 1
+                aID2pID[segID] = (self.pID, tli1, tli2)
+                paraAlignment = {'off_start': 0, 'off_end': len(curSent['text']), 'para_id': self.pID}
+                curSent['para_alignment'] = [paraAlignment]
+            else:
+                paraAlignment = {'off_start': 0, 'off_end': len(curSent['text']), 'para_id': pID}
+                curSent['para_alignment'] = [paraAlignment]
+        self.add_src_alignment(curSent, tli1, tli2, srcFile)
+        return curSent
 
-        for segNode in segments:
+    def process_tier(self, tierNode, lang, speaker, aID2pID, srcFile, alignedTier=False, pendingSegs=None):
+        """
+        Extract segments from the tier node and iterate over them, returning
+        them as JSON sentences. If alignedTier is True, IDs of the segments
+        whose parent segments have not been processed yet are added to
+        pendingSegs instead.
+        """
+        for segNode in _XP_SEGS(tierNode):
             if ('ANNOTATION_ID' not in segNode.attrib
-                    or segNode.attrib['ANNOTATION_ID'] not in self.segmentTree):
+                    or segNode.attrib['ANNOTATION_ID'] not in self.segContents):
                 continue
-            segData = self.segmentTree[segNode.attrib['ANNOTATION_ID']]
-            if not alignedTier:
-                if segData[2] is None or segData[3] is None:
-                    continue
-                tli1 = segData[2]
-                tli2 = segData[3]
-            elif segData[1] is not None:
-                aID = segData[1]
-                pID, tli1, tli2 = aID2pID[aID]
-            else:
+            segID = segNode.attrib['ANNOTATION_ID']
+            if (alignedTier and pendingSegs is not None
+                    and self.segParent[segID] is not None
+                    and self.segParent[segID] not in aID2pID):
+                pendingSegs.append(segID)
                 continue
-            text = segData[0]
-            curSent = {'text': text, 'words': None, 'lang': lang,
-                       'meta': {'speaker': speaker}}
-            if len(self.corpusSettings['aligned_tiers']) > 0:
-                if not alignedTier:
-                    self.pID += 1
-                    aID = segNode.attrib['ANNOTATION_ID']
-                    aID2pID[aID] = (self.pID, tli1, tli2)
-                    paraAlignment = {'off_start': 0, 'off_end': len(curSent['text']), 'para_id': self.pID}
-                    curSent['para_alignment'] = [paraAlignment]
-                else:
-                    paraAlignment = {'off_start': 0, 'off_end': len(curSent['text']), 'para_id': pID}
-                    curSent['para_alignment'] = [paraAlignment]
-            self.add_src_alignment(curSent, tli1, tli2, srcFile)
-            yield curSent
-
-    def get_sentences(self, srcTree, srcFile):
+            curSent = self.make_sentence(segID, lang, speaker, aID2pID, srcFile, alignedTier=alignedTier)
+            if curSent is not None:
+                yield curSent
+
+    def tier_matches(self, tierNode, rxTiers):
         """
-        Iterate over sentences in the XML tree.
+        Check if the tier ID or the tier type matches any of the
+        precompiled regexes.
         """
-        # mainTierTypes = '(' + ' | '.join('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + x + '\'] | ' +
-        #                                  '/ANNOTATION_DOCUMENT/TIER[@TIER_ID=\'' + x + '\']'
-        #                                  for x in self.corpusSettings['main_tiers']) + ')'
-        # mainTiers = srcTree.xpath(mainTierTypes)
-        mainTiers = []
-        alignedTiers = []
-        for tierNode in srcTree.xpath('/ANNOTATION_DOCUMENT/TIER'):
-            for tierRegex in self.corpusSettings['main_tiers']:
-                if not tierRegex.startswith('^'):
-                    tierRegex = '^' + tierRegex
-                if not tierRegex.endswith('$'):
-                    tierRegex += '$'
-                try:
-                    if re.search(tierRegex, tierNode.attrib['TIER_ID']) is not None:
-                        mainTiers.append(tierNode)
-                        break
-                    elif ('LINGUISTIC_TYPE_REF' in tierNode.attrib
-                          and re.search(tierRegex, tierNode.attrib['LINGUISTIC_TYPE_REF']) is not None):
-                        mainTiers.append(tierNode)
-                        break
-                except:
-                    pass
-            for tierRegex in self.corpusSettings['aligned_tiers']:
-                if not tierRegex.startswith('^'):
-                    tierRegex = '^' + tierRegex
-                if not tierRegex.endswith('$'):
-                    tierRegex += '$'
-                try:
-                    if re.search(tierRegex, tierNode.attrib['TIER_ID']) is not None:
-                        alignedTiers.append(tierNode)
-                        break
-                    elif ('LINGUISTIC_TYPE_REF' in tierNode.attrib
-                          and re.search(tierRegex, tierNode.attrib['LINGUISTIC_TYPE_REF']) is not None):
-                        alignedTiers.append(tierNode)
-                        break
-                except:
-                    pass
-        if len(mainTiers) <= 0:
+        for rxTier, v in rxTiers:
+            if rxTier.search(tierNode.attrib['TIER_ID']) is not None:
+                return True
+            if ('LINGUISTIC_TYPE_REF' in tierNode.attrib
+                    and rxTier.search(tierNode.attrib['LINGUISTIC_TYPE_REF']) is not None):
+                return True
+        return False
+
+    def get_sentences(self, tierNode, aID2pID, srcFile, pendingTiers):
+        """
+        Iterate over sentences in a single tier, if it is a main
+        or an aligned tier. If the tier is aligned and some of its parent
+        segments have not been processed yet, the tier's attributes,
+        language and pending segment IDs are added to pendingTiers.
+        """
+        isMain, isAligned, lang = self.classify_tier(tierNode)
+        if len(lang) <= 0:
             return
-        # if len(self.corpusSettings['aligned_tiers']) > 0:
-        #     alignedTierTypes = '(' + ' | '.join('/ANNOTATION_DOCUMENT/TIER[@LINGUISTIC_TYPE_REF=\'' + x + '\'] | ' +
-        #                                         '/ANNOTATION_DOCUMENT/TIER[@TIER_ID=\'' + x + '\']'
-        #                                         for x in self.corpusSettings['aligned_tiers']) + ')'
-        #     alignedTiers = srcTree.xpath(alignedTierTypes)
-        aID2pID = {}  # annotation ID -> (pID, tli1, tli2) correspondence
-        for tier in mainTiers:
-            for sent in self.process_tier(tier, aID2pID, srcFile, alignedTier=False):
+        if isMain:
+            speaker = self.tier_speaker(tierNode.attrib, alignedTier=False)
+            for sent in self.process_tier(tierNode, lang, speaker, aID2pID, srcFile, alignedTier=False):
                 yield sent
-        for tier in alignedTiers:
-            for sent in self.process_tier(tier, aID2pID, srcFile, alignedTier=True):
+        if isAligned:
+            pendingSegs = []
+            speaker = self.tier_speaker(tierNode.attrib, alignedTier=True)
+            for sent in self.process_tier(tierNode, lang, speaker, aID2pID, srcFile,
+                                          alignedTier=True, pendingSegs=pendingSegs):
                 yield sent
+            if len(pendingSegs) > 0:
+                pendingTiers.append((dict(tierNode.attrib), lang, pendingSegs))
 
-    def process_file(self, textSrc, dictFreqBySpeaker, dictDurBySpeaker):
-        srcTree = etree.XML(textSrc)
-        self.tlis = self.get_tlis(srcTree)
-        self.build_segment_tree(srcTree)
+    def get_pending_sentences(self, pendingTiers, aID2pID, srcFile):
+        """
+        Iterate over sentences of the aligned tiers that precede their
+        main tiers in the file. This is called after all tiers have
+        been read. Segments whose parents are not in a main tier are
+        counted in self.nSkippedAligned.
+        """
+        for tierAttrib, lang, pendingSegs in pendingTiers:
+            speaker = self.tier_speaker(tierAttrib, alignedTier=True)
+            for segID in pendingSegs:
+                curSent = self.make_sentence(segID, lang, speaker, aID2pID, srcFile, alignedTier=True)
+                if curSent is None:
+                    self.nSkippedAligned += 1
+                    continue
+                yield curSent
 
-        sentences = [s for s in self.get_sentences(srcTree, '')]
-        if len(sentences) <= 0:
-            return 0, 0
+    def iter_sentences(self, textSrc, srcFile):
+        """
+        Parse the EAF file incrementally and iterate over its sentences.
+        Each tier is discarded as soon as it has been processed, so only
+        one tier at a time is kept in memory. Time slots precede tiers
+        in EAF. Segments of aligned tiers that come before their main
+        tiers are processed after the whole file has been read.
+        """
+        self.tlis = {}
+        self.segContents = {}
+        self.segParent = {}
+        self.segTli1 = {}
+        self.segTli2 = {}
+        self.segmentChildren = {}
+        self.nSkippedAligned = 0
+        aID2pID = {}  # annotation ID -> (pID, tli1, tli2) correspondence
+        pendingTiers = []  # (tier attributes, language, [aID]) for aligned tiers
+        for event, elem in etree.iterparse(io.BytesIO(textSrc), events=('end',),
+                                           tag=('TIME_SLOT', 'TIER'), **_PARSER_OPTIONS):
+            if elem.tag == 'TIME_SLOT':
+                self.add_tli(elem)
+            elif 'TIER_ID' in elem.attrib:
+                self.cb_build_segment_tree(elem)
+                for sent in self.get_sentences(elem, aID2pID, srcFile, pendingTiers):
+                    yield sent
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        for sent in self.get_pending_sentences(pendingTiers, aID2pID, srcFile):
+            yield sent
 
+    def process_file(self, textSrc):
+        """
+        Count tokens and transcribed duration by speaker in one EAF file.
+        Return total duration, token count, token frequencies by speaker,
+        transcribed duration by speaker and the number of skipped aligned
+        segments for the file.
+        """
+        dictFreqBySpeaker = {}
+        dictDurBySpeaker = {}
         tokenCount = 0
-        sentences.sort(key=lambda s: (s['lang'], s['src_alignment'][0]['off_start_src']))
-        for i in range(len(sentences) - 1):
-            sentences[i]['text'] = self.convert_sentence(sentences[i]['text'])
-            if len(sentences[i]['text']) <= 1:
+        minStart, maxEnd = None, None
+        for sent in self.iter_sentences(textSrc, ''):
+            offStart = sent['src_alignment'][0]['off_start_src']
+            offEnd = sent['src_alignment'][0]['off_end_src']
+            if minStart is None or offStart < minStart:
+                minStart = offStart
+            if maxEnd is None or offEnd > maxEnd:
+                maxEnd = offEnd
+            text = self.convert_sentence(sent['text'])
+            if len(text) <= 1:
                 continue
-            speaker = sentences[i]['meta']['speaker']
+            speaker = sent['meta']['speaker']
             if speaker not in dictFreqBySpeaker:
-                dictFreqBySpeaker[speaker] = {}
-            for token in EafStats.rxWord.findall(sentences[i]['text']):
-                tokenCount += 1
-                try:
-                    dictFreqBySpeaker[speaker][token] += 1
-                except KeyError:
-                    dictFreqBySpeaker[speaker][token] = 1
+                dictFreqBySpeaker[speaker] = collections.Counter()
+            tokens = EafStats.rxWord.findall(text)
+            tokenCount += len(tokens)
+            dictFreqBySpeaker[speaker].update(tokens)
             if speaker not in dictDurBySpeaker:
                 dictDurBySpeaker[speaker] = 0
-            dictDurBySpeaker[speaker] += sentences[i]['src_alignment'][0]['off_end_src'] \
-                                         - sentences[i]['src_alignment'][0]['off_start_src']
-        duration = sentences[-1]['src_alignment'][0]['off_end_src'] - sentences[0]['src_alignment'][0]['off_start_src']
-        # print(fnameSrc, duration)
-        return duration, tokenCount
+            dictDurBySpeaker[speaker] += offEnd - offStart
+        if minStart is None:
+            return 0, 0, dictFreqBySpeaker, dictDurBySpeaker, self.nSkippedAligned
+        duration = maxEnd - minStart
+        return duration, tokenCount, dictFreqBySpeaker, dictDurBySpeaker, self.nSkippedAligned
 
     def sound_duration(self, dirName):
         """
         Calculate total duration of sound files in a folder
         """
         duration = 0
+        paths = []
         for root, dirs, files in os.walk(dirName):
             for fname in files:
-                if re.sub('.*\\.', '.', fname.lower()) not in EafStats.mediaExtensions:
+                if os.path.splitext(fname)[1].lower() not in EafStats.mediaExtensions:
                     continue
-                fname = os.path.join(root, fname)
-                try:
-                    with contextlib.closing(wave.open(fname, 'r')) as f:
-                        frames = f.getnframes()
-                        rate = f.getframerate()
-                        duration += frames / float(rate)
-                except:
-                    # This is slower, but works for more formats
-                    (source_rate, source_sig) = wav.read(fname)
-                    duration += len(source_sig) / float(source_rate)
+                paths.append(os.path.join(root, fname))
+        # Only the headers are read, so this is I/O bound
+        with ThreadPoolExecutor(max_workers=SOUND_READ_THREADS) as executor:
+            for fname, fileDuration in zip(paths, executor.map(_wav_duration_header, paths)):
+                if fileDuration is None:
+                    print('Could not read WAV header: ' + fname)
+                    if self.logFile is not None:
+                        self.log('Could not read WAV header, file skipped: ' + fname)
+                    continue
+                duration += fileDuration
         return duration
 
     def print_stats(self, dirnameOut, dictFreqBySpeaker, dictDurBySpeaker):
-        fDur = open(os.path.join(dirnameOut, 'duration_by_speaker.json'), 'w', encoding='utf-8')
-        json.dump(dictDurBySpeaker, fDur, ensure_ascii=False, indent=2, sort_keys=True)
+        fDur = open(os.path.join(dirnameOut, 'duration_by_speaker.json'), 'wb')
+        fDur.write(orjson.dumps(dictDurBySpeaker, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
         fDur.close()
-        fFreq = open(os.path.join(dirnameOut, 'tokens_by_speaker.json'), 'w', encoding='utf-8')
-        json.dump(dictFreqBySpeaker, fFreq, ensure_ascii=False, indent=2, sort_keys=True)
+        fFreq = open(os.path.join(dirnameOut, 'tokens_by_speaker.json'), 'wb')
+        fFreq.write(orjson.dumps(dictFreqBySpeaker, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
         fFreq.close()
 
-    def log(self, logDir, message):
+    def log(self, message):
         now = datetime.datetime.now()
-        fOut = open(os.path.join(logDir, 'log.txt'), 'a', encoding='utf-8')
-        fOut.write(now.strftime("%Y-%m-%d %H:%M:%S") + '\t' + message + '\n')
-        fOut.close()
+        self.logFile.write(now.strftime("%Y-%m-%d %H:%M:%S") + '\t' + message + '\n')
 
     def process_repo(self, repo):
+        dirnameOut = self.corpusSettings['stats_path']
+        if not os.path.exists(dirnameOut):
+            os.makedirs(dirnameOut)
+        self.logFile = open(os.path.join(dirnameOut, 'log.txt'), 'w', encoding='utf-8', buffering=1)
+        try:
+            self.collect_stats(repo, dirnameOut)
+        finally:
+            self.logFile.close()
+            self.logFile = None
+
+    def collect_stats(self, repo, dirnameOut):
+        """
+        Calculate statistics for the repository and write them
+        to dirnameOut. The log file has to be open.
+        """
         duration = 0
         transcrDuration = 0
         tokenCount = 0
         dictFreqBySpeaker = {}
         dictDurBySpeaker = {}
-        dirnameOut = self.corpusSettings['stats_path']
-
-        if not os.path.exists(dirnameOut):
-            os.makedirs(dirnameOut)
-        fOut = open(os.path.join(dirnameOut, 'log.txt'), 'w', encoding='utf-8')
-        fOut.close()
 
         # Calculate token counts and transcribed duration based on ELAN files
+        # Files are independent of each other, so they are processed
+        # in parallel and the results are merged afterwards.
+        # The tree is listed with ls-tree, and only EAF blobs are read
+        # from the object database by their SHA.
+        fnames = []
+        texts = []
         tree = repo.head.commit.tree
-        for item in tree.traverse():
-            if item.type == 'tree':
+        for entry in repo.git.ls_tree('-r', '-z', tree.hexsha).split('\0'):
+            if len(entry) <= 0:
                 continue
-            fname = item.path
+            objInfo, fname = entry.split('\t', 1)
+            objMode, objType, objSha = objInfo.split(' ')
             fileExt = os.path.splitext(fname.lower())[1][1:]
-            if fileExt != self.srcExt:
+            if objType != 'blob' or fileExt != self.srcExt:
                 continue
-            text = item.data_stream.read()
-            self.log(dirnameOut, fname + ' read.')
-            curDuration, curTokenCount = self.process_file(text, dictFreqBySpeaker, dictDurBySpeaker)
-            self.log(dirnameOut, fname + ': ' + str(curDuration) + 's., ' + str(curTokenCount) + ' words.')
-            transcrDuration += curDuration
-            tokenCount += curTokenCount
-
-        self.log(dirnameOut, 'Total transcribed duration: ' + self.str_duration(transcrDuration) + '.')
-        self.log(dirnameOut, 'Total tokens: ' + str(tokenCount) + '.')
+            fnames.append(fname)
+            texts.append(repo.odb.stream(binascii.unhexlify(objSha)).read())
+            self.log(fname + ' read.')
+        with ProcessPoolExecutor(initializer=_init_worker, initargs=(self,)) as executor:
+            results = executor.map(_process_file_worker, texts, chunksize=4)
+            for fname, (curDuration, curTokenCount, curFreqBySpeaker,
+                        curDurBySpeaker, curSkipped) in zip(fnames, results):
+                self.log(fname + ': ' + str(curDuration) + 's., ' + str(curTokenCount) + ' words.')
+                if curSkipped > 0:
+                    self.log(fname + ': ' + str(curSkipped)
+                             + ' aligned segments skipped: their parents are not in a main tier.')
+                transcrDuration += curDuration
+                tokenCount += curTokenCount
+                for speaker in curFreqBySpeaker:
+                    if speaker not in dictFreqBySpeaker:
+                        dictFreqBySpeaker[speaker] = collections.Counter()
+                    dictFreqBySpeaker[speaker].update(curFreqBySpeaker[speaker])
+                for speaker in curDurBySpeaker:
+                    if speaker not in dictDurBySpeaker:
+                        dictDurBySpeaker[speaker] = 0
+                    dictDurBySpeaker[speaker] += curDurBySpeaker[speaker]
+
+        self.log('Total transcribed duration: ' + self.str_duration(transcrDuration) + '.')
+        self.log('Total tokens: ' + str(tokenCount) + '.')
         # print('Total transcribed duration: ' + self.str_duration(transcrDuration) + '.')
         print('Total tokens: ' + str(tokenCount) + '.')
 
@@ -392,10 +495,52 @@ class EafStats:
             print('Calculating sound duration...')
             duration = self.sound_duration(self.corpusSettings['sound_path'])
             print('Total sound duration: ' + self.str_duration(duration) + '.')
-            self.log(dirnameOut, 'Total sound duration: ' + self.str_duration(duration) + '.')
+            self.log('Total sound duration: ' + self.str_duration(duration) + '.')
         dictDurBySpeaker['#TOTAL_SOUND_DURATION'] = duration
         self.print_stats(dirnameOut, dictFreqBySpeaker, dictDurBySpeaker)
 
 
+def _wav_duration_header(fname):
+    """
+    Calculate duration of a WAV file based on its header only, without
+    reading the sound data. Return None if the header cannot be parsed.
+    """
+    with open(fname, 'rb') as f:
+        riffHeader = f.read(12)
+        if len(riffHeader) < 12 or riffHeader[:4] != b'RIFF' or riffHeader[8:12] != b'WAVE':
+            return None
+        byteRate = None
+        while True:
+            chunkHeader = f.read(8)
+            if len(chunkHeader) < 8:
+                return None
+            chunkID, chunkSize = struct.unpack('<4sI', chunkHeader)
+            if chunkID == b'fmt ':
+                fmt = f.read(chunkSize + chunkSize % 2)
+                if len(fmt) < 16:
+                    return None
+                byteRate = struct.unpack('<I', fmt[8:12])[0]
+            elif chunkID == b'data':
+                if not byteRate:
+                    return None
+                # The size may be wrong if the recording was interrupted
+                dataSize = min(chunkSize, os.fstat(f.fileno()).st_size - f.tell())
+                return dataSize / byteRate
+            else:
+                f.seek(chunkSize + chunkSize % 2, 1)
+
+
+def _init_worker(eafStats):
+    """
+    Store the EafStats instance in a worker process.
+    """
+    global _workerStats
+    _workerStats = eafStats
+
+
+def _process_file_worker(textSrc):
+    return _workerStats.process_file(textSrc)
+
+
 if __name__ == '__main__':
     pass
@@ -11,6 +11,7 @@ f = open(os.path.join(SETTINGS_DIR, 'corpora.json'), 'r', encoding='utf-8')
 settings = json.loads(f.read())
 f.close()
 localizations = {}
+statsCache = {'mtimes': None, 'cs': None}  # CorpusStats object and modification times of its files
 
 
 def jsonp(func):
@@ -75,12 +76,40 @@ def set_locale(lang=''):
     return ''
 
 
+def get_stats_mtimes():
+    """
+    Return modification times of the statistics files of all corpora
+    (None for the files that do not exist).
+    """
+    mtimes = []
+    for corpus in settings:
+        for fname in ('duration_by_speaker.json', 'tokens_by_speaker.json'):
+            path = os.path.join(corpus['stats_dir'], fname)
+            if os.path.exists(path):
+                mtimes.append(os.path.getmtime(path))
+            else:
+                mtimes.append(None)
+    return tuple(mtimes)
+
+
+def get_corpus_stats():
+    """
+    Return a CorpusStats object. It is only rebuilt if any of the
+    statistics files has changed since the previous call.
+    """
+    mtimes = get_stats_mtimes()
+    if statsCache['cs'] is None or statsCache['mtimes'] != mtimes:
+        statsCache['cs'] = CorpusStats(settings)
+        statsCache['mtimes'] = mtimes
+    return statsCache['cs']
+
+
 @app.route('/')
 def index_page():
     """
     If arguments are given, return HTML for a single question/topic.
     Otherwise, return HTML of the start page.
     """
-    cs = CorpusStats(settings)
+    cs = get_corpus_stats()
     return render_template('stats.html',
                            corpora=cs.corpora)
@@ -1,6 +1,6 @@
 import os
-import json
-import copy
+import orjson
+import heapq
 
 
 MAX_FREQ_TOKENS = 100
@@ -13,29 +13,28 @@ class CorpusStats:
     """
 
     def __init__(self, settings):
-        self.corpora = copy.deepcopy(settings)
+        # Corpus settings only contain strings; everything else
+        # is added to the copies below
+        self.corpora = [dict(corpus) for corpus in settings]
         for corpus in self.corpora:
             if not os.path.exists(corpus['stats_dir']):
                 corpus['name'] += ' (FOLDER DOES NOT EXIST!)'
                 corpus['dur_by_speaker'] = {'XXX': 0}
                 corpus['tok_by_speaker'] = {'XXX': {'XXX': 0}}
                 continue
-            with open(os.path.join(corpus['stats_dir'], 'duration_by_speaker.json'),
-                      'r', encoding='utf-8') as fIn:
-                corpus['dur_by_speaker'] = json.load(fIn)
-            with open(os.path.join(corpus['stats_dir'], 'tokens_by_speaker.json'),
-                      'r', encoding='utf-8') as fIn:
-                corpus['tok_by_speaker'] = json.load(fIn)
+            with open(os.path.join(corpus['stats_dir'], 'duration_by_speaker.json'), 'rb') as fIn:
+                corpus['dur_by_speaker'] = orjson.loads(fIn.read())
+            with open(os.path.join(corpus['stats_dir'], 'tokens_by_speaker.json'), 'rb') as fIn:
+                corpus['tok_by_speaker'] = orjson.loads(fIn.read())
         self.calculate_stats()
 
     def str_duration(self, duration):
         """
         Present duration in a human-readable form.
         """
-        totalDurHours = round(duration // 3600)
-        totalDurMinutes = round((duration - totalDurHours * 3600) // 60)
-        totalDurSeconds = round(duration % 60)
-        return str(totalDurHours).zfill(2) + ':' + str(totalDurMinutes).zfill(2) + ':' + str(totalDurSeconds).zfill(2)
+        totalDurHours, totalDurSeconds = divmod(int(round(duration)), 3600)
+        totalDurMinutes, totalDurSeconds = divmod(totalDurSeconds, 60)
+        return f'{totalDurHours:02d}:{totalDurMinutes:02d}:{totalDurSeconds:02d}'
 
     def is_interviewer(self, speaker):
         """
@@ -70,33 +69,27 @@ class CorpusStats:
                                     for sp in corpus['dur_by_speaker']
                                     if not self.is_interviewer(sp))
 
-            # Total token count for all speakers
-            corpus['total_tok'] = 0
-            corpus['total_tok_by_speaker'] = {}
-            for sp in corpus['tok_by_speaker']:
-                corpus['total_tok_by_speaker'][sp] = 0
-                for tok in corpus['tok_by_speaker'][sp]:
-                    corpus['total_tok'] += corpus['tok_by_speaker'][sp][tok]
-                    corpus['total_tok_by_speaker'][sp] += corpus['tok_by_speaker'][sp][tok]
-
-            # Total token count for informants only
-            corpus['inf_tok'] = 0
-            for sp in corpus['tok_by_speaker']:
-                if self.is_interviewer(sp):
-                    continue
-                for tok in corpus['tok_by_speaker'][sp]:
-                    corpus['inf_tok'] += corpus['tok_by_speaker'][sp][tok]
-
-            # Common frequency list of tokens
-            corpus['tok_freq'] = {}
-            for sp in corpus['tok_by_speaker']:
-                for token in corpus['tok_by_speaker'][sp]:
-                    if token not in corpus['tok_freq']:
-                        corpus['tok_freq'][token] = corpus['tok_by_speaker'][sp][token]
-                    else:
-                        corpus['tok_freq'][token] += corpus['tok_by_speaker'][sp][token]
-            corpus['freq_tokens'] = [token for token in sorted(corpus['tok_freq'],
-                                                               key=lambda t: (-corpus['tok_freq'][t], t))][:MAX_FREQ_TOKENS]
+            # Token counts for all speakers and for informants only,
+            # and common frequency list of tokens
+            tokBySpeaker = corpus['tok_by_speaker']
+            totalTokBySpeaker = {}
+            tokFreq = {}
+            totalTok = 0
+            infTok = 0
+            for sp, toks in tokBySpeaker.items():
+                spTotal = sum(toks.values())
+                totalTokBySpeaker[sp] = spTotal
+                totalTok += spTotal
+                if not self.is_interviewer(sp):
+                    infTok += spTotal
+                for token, freq in toks.items():
+                    tokFreq[token] = tokFreq.get(token, 0) + freq
+            corpus['total_tok'] = totalTok
+            corpus['total_tok_by_speaker'] = totalTokBySpeaker
+            corpus['inf_tok'] = infTok
+            corpus['tok_freq'] = tokFreq
+            corpus['freq_tokens'] = [token for token, freq in heapq.nsmallest(MAX_FREQ_TOKENS, tokFreq.items(),
+                                                                             key=lambda tf: (-tf[1], tf[0]))]
 
             corpus['total_dur_str'] = self.str_duration(corpus['total_dur'])
             corpus['inf_dur_str'] = self.str_duration(corpus['inf_dur'])